@@ -1,6 +1,6 @@
 import calendar
-from datetime import date
-from typing import Tuple
+from functools import lru_cache
+from typing import Dict, Tuple
 
 
 # === ここをあなたのカレンダー画像に合わせて調整してください ===
@@ -15,27 +15,22 @@ CALENDAR_CONFIG = {
 }
 
 
-def get_day_position(target_date: date) -> Tuple[int, int]:
+@lru_cache(maxsize=4)
+def get_month_positions(year: int, month: int) -> Dict[int, Tuple[int, int]]:
     """
-    カレンダー画像上で、その月の target_date がどの座標に来るかを返す。
-    戻り値: (x, y)
+    その月の各日 (day -> (x, y)) の座標表を返す。
+    (year, month) だけで決まるのでキャッシュしておく。
     """
-    year = target_date.year
-    month = target_date.month
-    day = target_date.day
+    # 1日の曜日 (月=0 ... 日=6) と月の日数
+    first_weekday, days_in_month = calendar.monthrange(year, month)
+    # 日曜始まりのカレンダーで、1日が何列目に来るか
+    lead = (first_weekday + 1) % 7
 
-    cal = calendar.Calendar(firstweekday=6)  # 日曜始まり (6: Sunday)
-    month_days = list(cal.itermonthdates(year, month))
-
-    # month_days は、カレンダーの全マス（日付が前月・翌月にまたがる場合も）を日付順に並べたリスト
-    # 7列ごとに1週間とみなす
-    for idx, d in enumerate(month_days):
-        if d.month == month and d.day == day:
-            row = idx // 7
-            col = idx % 7
-            x = CALENDAR_CONFIG["offset_x"] + col * CALENDAR_CONFIG["cell_width"]
-            y = CALENDAR_CONFIG["offset_y"] + row * CALENDAR_CONFIG["cell_height"]
-            return x, y
-
-    # 万が一見つからない場合は左上を返す
-    return CALENDAR_CONFIG["offset_x"], CALENDAR_CONFIG["offset_y"]
+    # 1日の前に lead 個の空きマスがあり、7列ごとに1週間とみなす
+    positions: Dict[int, Tuple[int, int]] = {}
+    for day in range(1, days_in_month + 1):
+        row, col = divmod(lead + day - 1, 7)
+        x = CALENDAR_CONFIG["offset_x"] + col * CALENDAR_CONFIG["cell_width"]
+        y = CALENDAR_CONFIG["offset_y"] + row * CALENDAR_CONFIG["cell_height"]
+        positions[day] = (x, y)
+    return positions
@@ -1,28 +1,32 @@
 import os
 import asyncio
 import time  # OSのtimeモジュール (タイムゾーン用)
-from datetime import datetime, timedelta, date, time as pytime, timezone # datetimeのtimeをpytimeとして扱う
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, date, time as pytime, timezone, tzinfo # datetimeのtimeをpytimeとして扱う
+from functools import lru_cache
 from io import BytesIO
-from typing import Dict, Optional, List, Tuple
+from typing import Dict, Optional, List, Set, Tuple
 
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from PIL import Image
+from supabase import create_client, Client, ClientOptions
+from postgrest.exceptions import APIError
 
 # タイムゾーンの設定はインポート直後に行うのが安全
 os.environ['TZ'] = 'Asia/Tokyo'
 if hasattr(time, 'tzset'):
     time.tzset()
 
+JST = timezone(timedelta(hours=9))
+
 # 以降の from datetime import ... はすべて削除してください
 
-from app.date.calendar_utils import get_day_position # パスが正しいか確認してください
+from app.stamp_card import render_stamp_card
 
-import threading
-from app.server import run as run_server
+from app.server import serve as serve_api
 
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
@@ -37,7 +41,13 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Supabase の URL / KEY が設定されていません")
 if not GUILD_ID:
     raise RuntimeError("環境変数 GUILD_ID が設定されていません")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# クライアントは1つだけ作って使い回す（PostgREST の httpx セッションが keep-alive で接続を再利用する）。
+# to_thread 側のスレッドを長く塞がないよう、タイムアウトはデフォルト (120秒) より短くする
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(postgrest_client_timeout=10),
+)
 
 
 # Intents 設定（ボイス状態とメンバー情報が必要）
@@ -46,18 +56,43 @@ intents.message_content = False
 intents.members = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class MyBot(commands.Bot):
+    def __init__(self):
+        super().__init__(command_prefix="!", intents=intents)
+
+    async def setup_hook(self):
+        # 指定したギルドに対してグローバルコマンドをコピー
+        self.tree.copy_global_to(guild=guild)
+        await self.tree.sync(guild=guild)
+        print(f"Synced slash commands to {GUILD_ID}")
+
 
+# Bot インスタンスはこれ1つだけ（以降の @bot.event / @bot.tree.command はすべてこれに付く）
+bot = MyBot()
 
-# ====== サーバー 起動 ======
-threading.Thread(
-    target=run_server,
-    daemon=True
-).start()
 
 # ====== データモデル（メモリ上の一時状態） ======
 
 class ClubConfig:
+    # 部活の数だけ生成され、presence_checker で毎tick属性を読むので __dict__ を持たせない
+    __slots__ = (
+        "club_id",
+        "name",
+        "guild_id",
+        "voice_channel_id",
+        "start_time",
+        "window_minutes",
+        "required_minutes",
+        "monitor_offset_minutes",
+        "calendar_base_prefix",
+        "is_night",
+        "mention_role_id",
+        "window_timedelta",
+        "required_timedelta",
+        "required_seconds",
+        "_window_cache",
+    )
+
     def __init__(
         self,
         club_id: str,
@@ -79,22 +114,16 @@ class ClubConfig:
         self.start_time = start_time
         self.window_minutes = window_minutes
         self.required_minutes = required_minutes
-        self.monitor_offset_minutes = monitor_offset_minutes
+        self.monitor_offset_minutes = monitor_offset_minutes # clubs テーブルの列に合わせて持っているだけ（判定には使わない）
         self.calendar_base_prefix = calendar_base_prefix
         self.is_night = is_night
         self.mention_role_id = mention_role_id # 2. selfに代入して保持
-
-    @property
-    def window_timedelta(self) -> timedelta:
-        return timedelta(minutes=self.window_minutes)
-
-    @property
-    def required_timedelta(self) -> timedelta:
-        return timedelta(minutes=self.required_minutes)
-
-    @property
-    def monitor_offset_timedelta(self) -> timedelta:
-        return timedelta(minutes=self.monitor_offset_minutes)
+        # 分単位の設定から作る値は毎回作り直さず、ここで1回だけ計算しておく
+        self.window_timedelta = timedelta(minutes=window_minutes)
+        self.required_timedelta = timedelta(minutes=required_minutes)
+        self.required_seconds = required_minutes * 60
+        # get_today_window_range の結果 (日付, tzinfo, 開始, 終了)。日付が変わるまで使い回す
+        self._window_cache: Optional[Tuple[date, Optional[tzinfo], datetime, datetime]] = None
 
 
 
@@ -102,16 +131,35 @@ class ClubConfig:
 # ギルドごとのClub設定をキャッシュ
 club_cache: Dict[int, Dict[str, ClubConfig]] = {}  # guild_id -> {club_name: ClubConfig}
 
+# club_cache から作る派生インデックス。club_cache を書き換えたら必ず rebuild_club_indexes() で作り直すこと
+# 逆引き（VCの入退室イベントから対象クラブを1回の辞書引きで求める）
+vc_to_clubs: Dict[int, Dict[int, List[ClubConfig]]] = {}  # guild_id -> {voice_channel_id: [ClubConfig]}
+# presence_checker などで毎tick回す用の平たいリスト
+club_cache_list: Dict[int, List[ClubConfig]] = {}  # guild_id -> [ClubConfig]
+
 # VC滞在の一時集計（通信量削減のため、こまめにDBには書かず、しきい値到達時に書き込む）
-# key: (guild_id, club_id, user_id, date) -> accumulated seconds within window
-presence_accumulator: Dict[Tuple[int, str, int, date], int] = {}
+# 退室済みの滞在のうち判定窓に重なった秒数。今まさにVCにいる分は voice_sessions から計算する
+# key: (guild_id, club_id, date) -> {user_id: accumulated seconds within window}
+# 部活・日付ごとにまとめ、判定時は部活1つにつき1回だけ引けばよいようにする
+# 加算は defaultdict で分岐なしに行う。参照だけのときは .get() を使い、空エントリを作らないこと
+presence_accumulator: Dict[Tuple[int, str, date], Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+
+# VCに今いる人の入室時刻（on_voice_state_update で更新し、滞在時間は退室時や判定時にまとめて計算する）
+# key: (guild_id, club_id) -> {user_id: joined_at}
+voice_sessions: Dict[Tuple[int, str], Dict[int, datetime]] = {}
+
+# 今日すでにスタンプ済みの (guild_id, club_id, user_id, date)。
+# ここに入っている人は presence_checker で数えず、DBにも問い合わせない
+stamped_today: Set[Tuple[int, str, int, date]] = set()
 
 
 # ====== Supabase helper ======
 
 async def load_clubs_for_guild(guild_id: int):
     try:
-        res = supabase.table("clubs").select("*").eq("guild_id", guild_id).execute()
+        res = await asyncio.to_thread(
+            lambda: supabase.table("clubs").select("*").eq("guild_id", guild_id).execute()
+        )
         data = res.data
     except Exception as e:
         print(f"Error loading clubs: {e}")
@@ -119,12 +167,8 @@ async def load_clubs_for_guild(guild_id: int):
 
     clubs_by_name: Dict[str, ClubConfig] = {}
     for row in data:
-        # DBの時刻文字列をPythonのtimeオブジェクトに変換
-        try:
-           # 文字列から時刻を取り出し、pytime型として明示的に扱う（またはそのまま .time() メソッドを使う）
-            start_t = datetime.strptime(row["start_time"], "%H:%M:%S").time()
-        except ValueError:
-            start_t = datetime.strptime(row["start_time"], "%H:%M").time()
+        # DBの時刻文字列をPythonのtimeオブジェクトに変換（"HH:MM:SS" / "HH:MM" どちらも可）
+        start_t = pytime.fromisoformat(row["start_time"])
         
         club_cfg = ClubConfig(
             club_id=row["id"],
@@ -141,6 +185,20 @@ async def load_clubs_for_guild(guild_id: int):
         )
         clubs_by_name[club_cfg.name] = club_cfg
     club_cache[guild_id] = clubs_by_name
+    rebuild_club_indexes(guild_id)
+
+
+def rebuild_club_indexes(guild_id: int):
+    """
+    club_cache[guild_id] から vc_to_clubs[guild_id] と club_cache_list[guild_id] を作り直す。
+    1ギルドのクラブ数は少ないので、差分更新せず毎回まるごと作る。
+    """
+    clubs = list(club_cache.get(guild_id, {}).values())
+    index: Dict[int, List[ClubConfig]] = {}
+    for cfg in clubs:
+        index.setdefault(cfg.voice_channel_id, []).append(cfg)
+    vc_to_clubs[guild_id] = index
+    club_cache_list[guild_id] = clubs
 
 async def get_or_load_club(guild_id: int, club_name: str) -> Optional[ClubConfig]:
     if guild_id not in club_cache:
@@ -160,15 +218,7 @@ async def add_club_to_db(
     required_minutes: int = 6,
     monitor_offset_minutes: int = 20,
 ) -> ClubConfig:
-    # 1. 既存チェック
-    try:
-        res = supabase.table("clubs").select("*").eq("name", name).eq("guild_id", guild_id).execute()
-        if res.data:
-            raise ValueError("同じ名前の部活がすでに登録されています")
-    except Exception as e:
-        print(f"Check error: {e}")
-
-    # 2. 挿入用データの作成（必ずコロン ':' を使う）
+    # 1. 挿入用データの作成（必ずコロン ':' を使う）
     insert_data = {
         "name": name,
         "guild_id": guild_id,
@@ -182,19 +232,24 @@ async def add_club_to_db(
         "mention_role_id": mention_role_id, # ★ 追加
     }
 
-    # 3. DBへの挿入（リスト [ ] で囲んで渡す）
+    # 2. DBへの挿入（リスト [ ] で囲んで渡す）
+    # 同名チェックは clubs の (guild_id, name) ユニーク制約に任せ、1往復で済ませる
     try:
-        insert_res = (
-            supabase.table("clubs")
+        insert_res = await asyncio.to_thread(
+            lambda: supabase.table("clubs")
             .insert([insert_data])  # ここをリスト形式にする
             .execute()
         )
         row = insert_res.data[0]
+    except APIError as e:
+        if e.code == "23505":  # unique_violation
+            raise ValueError("同じ名前の部活がすでに登録されています")
+        raise RuntimeError(f"Supabase insert error: {e}")
     except Exception as e:
         # ここで「Object of type set...」が出る場合は、insert_dataの中身に問題があります
         raise RuntimeError(f"Supabase insert error: {e}")
 
-# 4. キャッシュ更新と返却
+# 3. キャッシュ更新と返却
     start_t = datetime.strptime(start_time_str, "%H:%M").time()
     cfg = ClubConfig(
         club_id=row["id"],
@@ -212,279 +267,377 @@ async def add_club_to_db(
     if guild_id not in club_cache:
         club_cache[guild_id] = {}
     club_cache[guild_id][cfg.name] = cfg
+    rebuild_club_indexes(guild_id)
+    presence_wakeup.set()
     return cfg
 
-async def record_stamp_if_needed(club: ClubConfig, user_id: int, date_obj: date, seconds_in_window: int):
-    if seconds_in_window < int(club.required_timedelta.total_seconds()):
-        return
-
+async def preload_today_stamps(guild_id: int):
+    """
+    そのギルドで今日すでに押されているスタンプを1回のクエリで取得し、stamped_today に入れる。
+    再起動直後でも、スタンプ済みの人を presence_checker が数え直さないようにするため。
+    """
+    today = datetime.now(JST).date()
     try:
-        # 重複チェック
-        res = supabase.table("stamps").select("*").eq("user_id", user_id).eq("guild_id", club.guild_id).eq("club_id", club.club_id).eq("date", date_obj.isoformat()).execute()
-        if res.data: return
-
-        # 挿入
-        supabase.table("stamps").insert({
-            "user_id": user_id,
-            "guild_id": club.guild_id,
-            "club_id": club.club_id,
-            "date": date_obj.isoformat(),
-        }).execute()
-
-# --- ここから通知処理を追加 ---
-        # 通知を送りたいチャンネルIDを事前に取得するか、特定の名前のチャンネルを探します
-        # 例: 「スタンプ通知」という名前のチャンネルに送る場合
-        guild = bot.get_guild(club.guild_id)
-        if guild:
-            # チャンネル名で探す例（特定のIDにする場合は guild.get_channel(ID)）
-            target_channel = discord.utils.get(guild.text_channels, name="スタンプ帳確認")
-            if target_channel:
-                await target_channel.send(f"🎉 <@{user_id}> さん、今日の **{club.name}** スタンプを獲得しました！")
-        # ----------------------------
+        res = await asyncio.to_thread(
+            lambda: supabase.table("stamps")
+            .select("user_id, club_id")
+            .eq("guild_id", guild_id)
+            .eq("date", today.isoformat())
+            .execute()
+        )
     except Exception as e:
-        print(f"Error recording stamp: {e}")
-
-
-async def get_stats_for_user(club: ClubConfig, user_id: int) -> Tuple[int, int, int]:
-    res = (
-        supabase.table("stamps")
-        .select("date")
-        .eq("user_id", user_id)
-        .eq("guild_id", club.guild_id)
-        .eq("club_id", club.club_id)
-        .order("date", desc=False)
-        .execute()
-    )
+        print(f"Error preloading today's stamps: {e}")
+        return
 
-    dates = sorted(list(set([datetime.strptime(r["date"], "%Y-%m-%d").date() for r in res.data])))
-    if not dates:
-        return 0, 0, 0
+    stamped_today.update((guild_id, r["club_id"], r["user_id"], today) for r in res.data)
 
-    total = len(dates)
-    max_streak = 0
-    current_streak = 0
-    
-    # 全期間の最大連続日数を計算
-    temp_streak = 1
-    for i in range(1, len(dates)):
-        if dates[i] == dates[i-1] + timedelta(days=1):
-            temp_streak += 1
-        else:
-            max_streak = max(max_streak, temp_streak)
-            temp_streak = 1
-    max_streak = max(max_streak, temp_streak)
 
-    # 「現在」の連続日数を計算（昨日または今日にスタンプがあるか）
-    today = date.today()
-    if dates[-1] == today or dates[-1] == today - timedelta(days=1):
-        current_streak = 1
-        for i in range(len(dates)-1, 0, -1):
-            if dates[i] == dates[i-1] + timedelta(days=1):
-                current_streak += 1
-            else:
-                break
-    else:
-        current_streak = 0
+# 通知を送るテキストチャンネル名と、ギルドごとに解決済みのチャンネルID
+NOTIFY_CHANNEL_NAME = "スタンプ帳確認"
+notify_channel_ids: Dict[int, int] = {}  # guild_id -> channel_id
 
-    return total, current_streak, max_streak
 
-# ====== スタンプカード画像生成 ======
-
-def load_calendar_base_image(club: ClubConfig, target_date: date) -> Image.Image:
+def get_notify_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
     """
-    指定日のカレンダー画像ベースを読み込む。
-    ファイル名: images/calendar_base_yyyy_mm(.png or _n.png)
-    prefix で切り替え可能とする。
+    ギルドの「スタンプ帳確認」チャンネルを返す。
+    名前での全チャンネル検索は初回（またはチャンネルが消えた・改名された後）だけにして、
+    以降はIDから1回の辞書引きで取り出す。
     """
-    year = target_date.year
-    month = target_date.month
-
-    base_dir = os.path.join(os.path.dirname(__file__), "images")
-
-    # ベース名（例）: calendar_base_2025_01.png / calendar_base_2025_01_n.png
-    if club.is_night:
-        filename = f"{club.calendar_base_prefix}_{year}_{month:02d}_n.png"
-    else:
-        filename = f"{club.calendar_base_prefix}_{year}_{month:02d}.png"
+    channel_id = notify_channel_ids.get(guild.id)
+    if channel_id is not None:
+        channel = guild.get_channel(channel_id)
+        if isinstance(channel, discord.TextChannel) and channel.name == NOTIFY_CHANNEL_NAME:
+            return channel
 
-    path = os.path.join(base_dir, filename)
+    channel = discord.utils.get(guild.text_channels, name=NOTIFY_CHANNEL_NAME)
+    if channel:
+        notify_channel_ids[guild.id] = channel.id
+    return channel
 
-    if not os.path.exists(path):
-        # デフォルト名 fallback
-        if club.is_night:
-            default_name = f"calendar_base_{year}_{month:02d}_n.png"
-        else:
-            default_name = f"calendar_base_{year}_{month:02d}.png"
-        path = os.path.join(base_dir, default_name)
 
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"カレンダーベース画像が見つかりません: {path}")
+# record_stamps が1回の upsert で送る最大行数
+STAMP_BATCH_SIZE = 1000
 
-    img = Image.open(path).convert("RGBA")
-    return img
 
+async def record_stamps(candidates: List[Tuple[ClubConfig, int, date]]):
+    """
+    必要滞在時間に達した (club, user_id, date) をまとめて upsert で書き込む。
+    stamps の (user_id, guild_id, club_id, date) ユニーク制約で重複は無視されるので、
+    返ってくるのは今回新しく押されたスタンプだけ。
+    """
+    if not candidates:
+        return
 
-def apply_stamps_to_calendar(
-    club: ClubConfig,
-    target_date: date,
-    stamp_dates: List[date],
-) -> BytesIO:
-    # ベース画像を読み込み
-    img = load_calendar_base_image(club, target_date)
-    
-    # スタンプ画像を読み込み（images/stamp.png が必要）
-    base_dir = os.path.join(os.path.dirname(__file__), "images")
-    stamp_path = os.path.join(base_dir, "stamp.png")
-    if not os.path.exists(stamp_path):
-        raise FileNotFoundError(f"スタンプ画像が見つかりません: {stamp_path}")
-    
-    stamp_img = Image.open(stamp_path).convert("RGBA")
-    
-# --- ここでサイズを調整 ---
-    # マス目のサイズ (150, 100) より少し小さくすると綺麗に収まります
-    # 例: 幅 120px にリサイズ（アスペクト比を維持する場合）
-    target_width = 250 
-    ratio = target_width / stamp_img.width
-    target_height = int(stamp_img.height * ratio)
-    stamp_img = stamp_img.resize((target_width, target_height), Image.LANCZOS)
-    # --------------------------
-
-    # スタンプを合成
-    for d in stamp_dates:
+    clubs_by_id = {club.club_id: club for club, _, _ in candidates}
+    keys = [(club.guild_id, club.club_id, user_id, date_obj) for club, user_id, date_obj in candidates]
+    rows = [
+        {
+            "user_id": user_id,
+            "guild_id": club.guild_id,
+            "club_id": club.club_id,
+            "date": date_obj.isoformat(),
+        }
+        for club, user_id, date_obj in candidates
+    ]
+
+    # 1リクエストが大きくなりすぎないよう STAMP_BATCH_SIZE 行ずつに分けて送る
+    inserted: List[dict] = []
+    for i in range(0, len(rows), STAMP_BATCH_SIZE):
+        batch = rows[i:i + STAMP_BATCH_SIZE]
         try:
-            x, y = get_day_position(d)
-            # 中央寄せにしたい場合は、座標にオフセットを加える
-            # 例: (x + 15, y + 10) など
-            img.alpha_composite(stamp_img, dest=(int(x + 15), int(y + 5)))
+            res = await asyncio.to_thread(
+                lambda: supabase.table("stamps")
+                .upsert(batch, on_conflict="user_id,guild_id,club_id,date", ignore_duplicates=True)
+                .execute()
+            )
         except Exception as e:
-            print(f"Stamp position error for {d}: {e}")
+            print(f"Error recording stamp: {e}")
+            continue
+        inserted.extend(res.data)
+        # 新規・既存どちらでも、この batch の人は今日スタンプ済み
+        stamped_today.update(keys[i:i + STAMP_BATCH_SIZE])
+        for key in keys[i:i + STAMP_BATCH_SIZE]:
+            # スタンプが確定したら積算はもう要らない（以降は stamped_today で素通りする）
+            accumulated = presence_accumulator.get((key[0], key[1], key[3]))
+            if accumulated:
+                accumulated.pop(key[2], None)
+            stamp_card_cache.pop(key[:3], None)
+
+    # 新しいスタンプが入った部活のランキングは数え直す
+    for club_id in {row["club_id"] for row in inserted}:
+        for period in RANKING_PERIODS:
+            ranking_cache.pop((club_id, period), None)
+
+    # 新しく押されたスタンプだけ「スタンプ帳確認」チャンネルに通知
+    # 送信は互いに独立しているので、1件ずつ待たずにまとめて投げる
+    sends = []
+    for row in inserted:
+        club = clubs_by_id.get(row["club_id"])
+        if not club:
+            continue
+        guild = bot.get_guild(club.guild_id)
+        if not guild:
             continue
+        target_channel = get_notify_channel(guild)
+        if target_channel:
+            sends.append(target_channel.send(f"🎉 <@{row['user_id']}> さん、今日の **{club.name}** スタンプを獲得しました！"))
 
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"Error sending stamp notification: {result}")
 
-async def get_stamp_dates_for_month(club: ClubConfig, user_id: int, month_date: date) -> List[date]:
-    start_d = date(month_date.year, month_date.month, 1)
-    if month_date.month == 12:
-        end_d = date(month_date.year + 1, 1, 1)
-    else:
-        end_d = date(month_date.year, month_date.month + 1, 1)
-
-    res = (
-        supabase.table("stamps")
-        .select("date")
-        .eq("user_id", user_id)
-        .eq("guild_id", club.guild_id)
-        .eq("club_id", club.club_id)
-        .gte("date", start_d.isoformat())
-        .lt("date", end_d.isoformat())
-        .order("date", desc=False)
-        .execute()
-    )
 
-    return [datetime.strptime(r["date"], "%Y-%m-%d").date() for r in res.data]
+@lru_cache(maxsize=4096)
+def parse_stamp_date(value: str) -> date:
+    # stamps.date の "YYYY-MM-DD" 文字列を date に変換する。
+    # 同じ日付はユーザーや呼び出しをまたいで何度も出てくるのでキャッシュしておく
+    return date.fromisoformat(value)
 
 
-# ====== VC監視ロジック ======
+# /card の取得結果を少しの間使い回す（連打や他人のカードの見比べで同じ問い合わせを繰り返さない）
+# key: (guild_id, club_id, user_id) -> (期限 (time.monotonic), today, 結果)
+# スタンプが押されたら record_stamps で該当ユーザーの分を捨てる
+STAMP_CARD_CACHE_TTL = 60
+stamp_card_cache: Dict[Tuple[int, str, int], Tuple[float, date, Tuple[List[date], int, int, int]]] = {}
+
 
-def get_today_window_range(club: ClubConfig, tz: Optional[datetime.tzinfo] = None) -> Tuple[datetime, datetime]:
+async def get_stamp_card_data(club: ClubConfig, user_id: int, today: date) -> Tuple[List[date], int, int, int]:
     """
-    今日の club の「判定窓」の開始と終了 (datetime) を返す。
-    offset は「監視開始」のために別管理で使う。
+    (今月のスタンプ日付, 累計, 現在の連続日数, 最大連続日数) を返す。
+    get_stamp_card RPC で、カレンダー用の日付と統計を1回の往復で取得する。
     """
-    now = datetime.now(tz=tz)
-    start_dt = datetime.combine(now.date(), club.start_time).replace(tzinfo=now.tzinfo)
-    end_dt = start_dt + club.window_timedelta
-    return start_dt, end_dt
+    key = (club.guild_id, club.club_id, user_id)
+    cached = stamp_card_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic() and cached[1] == today:
+        return cached[2]
+
+    res = await asyncio.to_thread(
+        lambda: supabase.rpc(
+            "get_stamp_card",
+            {
+                "p_user_id": user_id,
+                "p_guild_id": club.guild_id,
+                "p_club_id": club.club_id,
+                "p_today": today.isoformat(),
+            },
+        ).execute()
+    )
+    if res.data:
+        row = res.data[0]
+        result = (
+            [parse_stamp_date(d) for d in row["month_dates"] or []],
+            row["total"],
+            row["current_streak"],
+            row["max_streak"],
+        )
+    else:
+        result = ([], 0, 0, 0)
+
+    stamp_card_cache[key] = (time.monotonic() + STAMP_CARD_CACHE_TTL, today, result)
+    return result
+
+# ====== スタンプカード画像生成 ======
 
+# /card の画像生成専用のスレッドプール（描画本体は app/stamp_card.py）。
+# 1枚あたり数十MBの RGBA バッファを扱うので、同時に生成する枚数を制限する。
+# main.py は import 時に Bot や Supabase を初期化するので、spawn のプロセスプールにすると
+# ワーカーごとに __mp_main__ として丸ごと読み込み直されてしまう。そのためスレッドで回す。
+card_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="card")
 
-def get_today_monitor_range(club: ClubConfig, tz: Optional[datetime.tzinfo] = None) -> Tuple[datetime, datetime]:
+# ====== VC監視ロジック ======
+
+def get_today_window_range(club: ClubConfig, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
     """
-    今日の「監視開始～終了」の範囲を返す。
-    （例）11:00開始で offset=20, window=15 の場合
-      監視: 10:40～11:15
+    now の日付における club の「判定窓」の開始と終了 (datetime) を返す。
+    同じ日のうちは datetime を作り直さず、ClubConfig に持たせた結果を返す。
     """
-    start_window, end_window = get_today_window_range(club, tz=tz)
-    monitor_start = start_window - club.monitor_offset_timedelta
-    monitor_end = end_window
-    return monitor_start, monitor_end
+    if now is None:
+        now = datetime.now()
+    today = now.date()
+    cached = club._window_cache
+    if cached is not None and cached[0] == today and cached[1] is now.tzinfo:
+        return cached[2], cached[3]
 
-class MyBot(commands.Bot):
-    def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)
+    start_dt = datetime.combine(today, club.start_time).replace(tzinfo=now.tzinfo)
+    end_dt = start_dt + club.window_timedelta
+    club._window_cache = (today, now.tzinfo, start_dt, end_dt)
+    return start_dt, end_dt
 
-    async def setup_hook(self):
-        # 指定したギルドに対してグローバルコマンドをコピー
-        self.tree.copy_global_to(guild=guild)
-        await self.tree.sync(guild=guild)
-        print(f"Synced slash commands to {GUILD_ID}")
 
-bot = MyBot()
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
     print(f"現在時刻: {datetime.now()}")
     # クラブ設定ロード
+    now = datetime.now(JST)
     for g in bot.guilds:
         await load_clubs_for_guild(g.id)
+        await preload_today_stamps(g.id)
+        # 起動時（再接続時）にすでにVCにいる人、切断中に抜けた人を反映する
+        for vc_id, clubs in vc_to_clubs.get(g.id, {}).items():
+            await sync_voice_sessions(g, vc_id, clubs, now)
     print("Club configs loaded.")
-    presence_checker.start()
+    if not presence_checker.is_running():
+        presence_checker.start()
+    if not daily_rollover.is_running():
+        daily_rollover.start()
 
 
 def get_club_for_voice_channel(guild_id: int, channel_id: int) -> List[ClubConfig]:
     """
     そのVCを監視対象にしているクラブを返す（複数の可能性もあるのでリスト）
     """
-    clubs = club_cache.get(guild_id, {})
-    result = []
-    for cfg in clubs.values():
-        if cfg.voice_channel_id == channel_id:
-            result.append(cfg)
-    return result
+    return vc_to_clubs.get(guild_id, {}).get(channel_id, [])
+
+
+def window_overlap_seconds(
+    joined_at: datetime, until: datetime, window_start: datetime, window_end: datetime
+) -> int:
+    """
+    joined_at〜until の滞在のうち、判定窓 (window_start〜window_end) に重なっている秒数を返す。
+    「11時以前からいた」人も、実際の必要時間カウントは 11:00〜11:15 の間とする。
+    """
+    overlap = min(until, window_end) - max(joined_at, window_start)
+    return max(0, int(overlap.total_seconds()))
+
+
+async def end_voice_session(club: ClubConfig, user_id: int, now: datetime):
+    """
+    退室したユーザーの滞在のうち判定窓に重なった分を presence_accumulator に加算する。
+    それで必要時間に達したら、その場でスタンプを押す。
+    """
+    joined_at = voice_sessions.get((club.guild_id, club.club_id), {}).pop(user_id, None)
+    if joined_at is None:
+        return
+
+    window_start, window_end = get_today_window_range(club, now)
+    seconds = window_overlap_seconds(joined_at, now, window_start, window_end)
+    if seconds <= 0:
+        return
+
+    key = (club.guild_id, club.club_id, user_id, window_start.date())
+    if key in stamped_today:
+        return
+
+    accumulated = presence_accumulator[(club.guild_id, club.club_id, key[3])]
+    accumulated[user_id] += seconds
+    total = accumulated[user_id]
+    if total >= club.required_seconds:
+        await record_stamps([(club, user_id, key[3])])
+
+
+async def sync_voice_sessions(
+    guild: discord.Guild, voice_channel_id: int, clubs: List[ClubConfig], now: datetime
+):
+    """
+    VCに今いるメンバーと、そのVCを監視する clubs の voice_sessions を突き合わせる。
+    （起動時・再接続時・部活追加時など、入退室イベントを受け取れていない間の差分を埋める）
+    同じVCを複数の部活が使っていても、メンバー一覧を見るのはVCごとに1回だけ。
+    """
+    channel = guild.get_channel(voice_channel_id)
+    if isinstance(channel, discord.VoiceChannel):
+        present = {m.id for m in channel.members if not m.bot}
+    else:
+        present = set()
+
+    for club in clubs:
+        sessions = voice_sessions.setdefault((guild.id, club.club_id), {})
+        for user_id in [u for u in sessions if u not in present]:
+            await end_voice_session(club, user_id, now)
+        for user_id in present:
+            sessions.setdefault(user_id, now)
 
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     """
-    VC入退室を検知して、監視時間内なら presence_accumulator に滞在時間を積算する。
-    ただし「リアルタイムで秒数カウント」するのではなく、
-    presence_checker で定期的に状態を確認してもよいが、
-    ここでは「join/leave と同時に時間を記録する」簡易方式は難しいため、
-    別アプローチをとる。
-    ----
-    通信量削減＆ロジック簡略化のため、
-    実際には periodic check（presence_checker）で
-    今 VC にいるユーザを見て、その時刻に応じて秒数加算する。
-    なので on_voice_state_update では何もしなくてもよいが、
-    将来の拡張のために置いておく。
+    VC入退室を検知して、監視対象VCの入室時刻を voice_sessions に記録する。
+    退室（別VCへの移動を含む）時に、判定窓に重なった滞在時間を presence_accumulator に積算する。
+    VCに誰もいなければ presence_checker 側の仕事もない。
+    """
+    if member.bot:
+        return
+
+    before_id = before.channel.id if before.channel else None
+    after_id = after.channel.id if after.channel else None
+    if before_id == after_id:
+        return  # ミュート切り替えなど、VC自体は変わっていない
+
+    now = datetime.now(JST)
+    if before_id is not None:
+        for club in get_club_for_voice_channel(member.guild.id, before_id):
+            await end_voice_session(club, member.id, now)
+    if after_id is not None:
+        for club in get_club_for_voice_channel(member.guild.id, after_id):
+            voice_sessions.setdefault((member.guild.id, club.club_id), {})[member.id] = now
+
+# 5分前通知を送った (club_id, date)。daily_rollover で前日以前の分を捨てる
+notified_keys: Set[Tuple[str, date]] = set()
+
+# 判定窓の終了後も少しだけ presence_checker を回し、窓の終わりまでの滞在を確定させる
+WINDOW_GRACE = timedelta(seconds=30)
+
+# 部活の追加・削除で presence_checker の待機を打ち切るためのイベント
+presence_wakeup = asyncio.Event()
+
+
+def get_next_activation(now: datetime) -> Optional[datetime]:
+    """
+    presence_checker が次に仕事をする時刻（いずれかの部活の5分前通知 or 判定窓の開始）を返す。
+    判定窓の最中の部活があれば now を、部活が1つもなければ None を返す。
+    """
+    next_at: Optional[datetime] = None
+    for guild_clubs in club_cache_list.values():
+        for club in guild_clubs:
+            window_start, window_end = get_today_window_range(club, now)
+            if window_start <= now <= window_end + WINDOW_GRACE:
+                return now
+            for at in (window_start - timedelta(minutes=5), window_start):
+                if at <= now:
+                    at += timedelta(days=1)
+                if next_at is None or at < next_at:
+                    next_at = at
+    return next_at
+
+
+async def wait_for_next_activation(now: datetime):
+    """
+    判定窓も通知も近くにない間は、30秒ごとに空回りせず次の仕事の時刻まで眠る。
+    部活の追加・削除があれば presence_wakeup で起こされる。
     """
-    return  # ここでは特に何もしない。すべて presence_checker に任せる。
+    next_at = get_next_activation(now)
+    if next_at is not None and next_at - now <= timedelta(seconds=30):
+        return  # 通常の30秒間隔で間に合う
+
+    timeout = None if next_at is None else (next_at - now).total_seconds()
+    try:
+        await asyncio.wait_for(presence_wakeup.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    presence_wakeup.clear()
 
-notified_keys = set()
 
 @tasks.loop(seconds=30)
 async def presence_checker():
-    # 修正：JSTを指定して取得
-    jst = timezone(timedelta(hours=9))
-    now = datetime.now(jst)
+    now = datetime.now(JST)
 
     five_min_later_str = (now + timedelta(minutes=5)).strftime("%H:%M")
-    today_str = now.strftime("%Y-%m-%d")
+
+    # このtickで必要時間に達した (club, user_id, date)。最後にまとめて書き込む
+    pending_stamps: List[Tuple[ClubConfig, int, date]] = []
 
     for guild in bot.guilds:
-        guild_clubs = club_cache.get(guild.id, {})
+        guild_clubs = club_cache_list.get(guild.id)
         if not guild_clubs:
             continue
 
-        for club in guild_clubs.values():
+        for club in guild_clubs:
             # --- 追加: 5分前通知ロジック ---
             club_time_str = club.start_time.strftime("%H:%M")
-            notify_key = f"notif_{club.club_id}_{today_str}"
+            notify_key = (club.club_id, now.date())
 
             if five_min_later_str == club_time_str and notify_key not in notified_keys:
-                target_channel = discord.utils.get(guild.text_channels, name="スタンプ帳確認")
+                target_channel = get_notify_channel(guild)
                 if target_channel and club.mention_role_id:
                     try:
                         await target_channel.send(
@@ -496,38 +649,58 @@ async def presence_checker():
                         print(f"Error sending notification: {e}")
             # ----------------------------
             
-            monitor_start, monitor_end = get_today_monitor_range(club, tz=now.tzinfo)
-            window_start, window_end = get_today_window_range(club, tz=now.tzinfo)
+            window_start, window_end = get_today_window_range(club, now)
 
-            # 今日の監視時間外ならスキップ
-            if not (monitor_start <= now <= monitor_end):
+            # 滞在時間を数えるのは判定窓の中だけなので、窓の外ならクラブごとスキップ
+            # （窓の終わりまでの滞在を確定させるため、終了後 WINDOW_GRACE だけは回す）
+            if not (window_start <= now <= window_end + WINDOW_GRACE):
                 continue
 
-            # VC オブジェクト取得
-            channel = guild.get_channel(club.voice_channel_id)
-            if not isinstance(channel, discord.VoiceChannel):
+            # VCに今いる人（on_voice_state_update で記録済み）。誰もいなければ何もしない
+            sessions = voice_sessions.get((guild.id, club.club_id))
+            if not sessions:
                 continue
 
-            # VCに現在いるメンバー
-            members = channel.members
+            key_date = window_start.date()
+            accumulated = presence_accumulator.get((guild.id, club.club_id, key_date), {})
 
-            for member in members:
-                if member.bot:
+            for user_id, joined_at in sessions.items():
+                key = (guild.id, club.club_id, user_id, key_date)
+                if key in stamped_today:
                     continue
-                # 判定窓内にいるときだけ滞在時間をカウント（「11時以前からいた」人も、
-                # 実際の必要時間カウントは 11:00〜11:15 の間とする）
-                if window_start <= now <= window_end:
-                    key_date = window_start.date()
-                    key = (guild.id, club.club_id, member.id, key_date)
-                    
-                    # 30秒ぶん加算
-                    presence_accumulator[key] = presence_accumulator.get(key, 0) + 30
-                    
-                    print(f"DEBUG: {member.display_name} is in window! Current seconds: {presence_accumulator[key]}")
-
-                    # 必要時間を超えたらスタンプ
-                    seconds = presence_accumulator[key]
-                    await record_stamp_if_needed(club, member.id, key_date, seconds)
+
+                # 退室済みの分 + 今回の入室から今までの分（判定窓に重なる範囲だけ）
+                seconds = accumulated.get(user_id, 0) + window_overlap_seconds(
+                    joined_at, now, window_start, window_end
+                )
+
+                # 必要時間を超えたらスタンプ候補に追加
+                if seconds >= club.required_seconds:
+                    pending_stamps.append((club, user_id, key_date))
+
+    await record_stamps(pending_stamps)
+
+    await wait_for_next_activation(datetime.now(JST))
+
+@tasks.loop(time=pytime(0, 0, tzinfo=JST))
+async def daily_rollover():
+    """
+    日付が変わったら、前日以前の stamped_today・presence_accumulator・notified_keys を捨て、
+    今日のスタンプ済みを読み込み直す。（放っておくと日ごとにキーが増え続ける）
+    """
+    today = datetime.now(JST).date()
+    for key in [k for k in stamped_today if k[3] < today]:
+        stamped_today.discard(key)
+    for key in [k for k in presence_accumulator if k[2] < today]:
+        del presence_accumulator[key]
+    for key in [k for k in notified_keys if k[1] < today]:
+        notified_keys.discard(key)
+    # /card のキャッシュは日付ごとの結果なので、日付が変わったらすべて無効
+    stamp_card_cache.clear()
+
+    # 日付をまたいで動いている判定窓の分など、今日すでにあるスタンプを読み直す
+    for g in bot.guilds:
+        await preload_today_stamps(g.id)
 
 # ====== スラッシュコマンド ======
 
@@ -572,12 +745,14 @@ async def add_club(
         await interaction.response.send_message(f"エラーが発生しました: {e}", ephemeral=True)
         return
 
+    # すでにそのVCにいる人も入室済みとして扱う
+    await sync_voice_sessions(interaction.guild, cfg.voice_channel_id, [cfg], datetime.now(JST))
+
     await interaction.response.send_message(
         f"部活 `{cfg.name}` を登録しました。\n"
         f"通知ロール: {mention_role.mention}\n" # ★ 確認メッセージにロールを表示
         f"開始時刻: {cfg.start_time.strftime('%H:%M')}\n"
         f"VC: {voice_channel.mention}\n"
-        f"監視開始: 開始 {cfg.monitor_offset_minutes} 分前から\n"
         f"判定窓: {cfg.window_minutes} 分 / 必要滞在: {cfg.required_minutes} 分\n"
         f"カレンダーベース: {cfg.calendar_base_prefix} (night={cfg.is_night})"
     )
@@ -610,12 +785,17 @@ async def remove_club(interaction: discord.Interaction, club_name: str):
 
     try:
         # 1. Supabaseから削除
-        supabase.table("clubs").delete().eq("id", club.club_id).execute()
+        await asyncio.to_thread(
+            lambda: supabase.table("clubs").delete().eq("id", club.club_id).execute()
+        )
 
         # 2. キャッシュからも削除
         if interaction.guild_id in club_cache:
             if club_name in club_cache[interaction.guild_id]:
                 del club_cache[interaction.guild_id][club_name]
+                rebuild_club_indexes(interaction.guild_id)
+                presence_wakeup.set()
+        voice_sessions.pop((interaction.guild_id, club.club_id), None)
 
         await interaction.followup.send(f"部活 `{club_name}` の設定を完全に削除しました。", ephemeral=True)
 
@@ -640,20 +820,25 @@ async def card(
         return
 
     today = date.today()
-    # 修正: 引数に today を追加
-    stamp_dates = await get_stamp_dates_for_month(club, member.id, today)
+    # 今月分の日付（描画用）と統計（DB側で集計）を1回の RPC で取得
+    stamp_dates, total_days, current_streak, max_streak = await get_stamp_card_data(club, member.id, today)
 
     try:
-        # 修正: asyncio.to_thread を使用
-        buf = await asyncio.to_thread(apply_stamps_to_calendar, club, today, stamp_dates)
+        # 画像生成は card_executor のスレッドで行い、イベントループを塞がない
+        png = await asyncio.get_running_loop().run_in_executor(
+            card_executor,
+            render_stamp_card,
+            club.calendar_base_prefix,
+            club.is_night,
+            today.year,
+            today.month,
+            tuple(d.day for d in stamp_dates),
+        )
     except Exception as e:
         await interaction.followup.send(f"画像生成エラー: {e}", ephemeral=True)
         return
     
-# 統計情報の取得
-    total_days, current_streak, max_streak = await get_stats_for_user(club, member.id)
-
-    file = discord.File(buf, filename="stamp_card.png")
+    file = discord.File(BytesIO(png), filename="stamp_card.png")
     
     # --- 装飾版 Embed ---
     embed = discord.Embed(
@@ -693,12 +878,21 @@ async def card(
 
 
 # ====== ランキング表示 ======
+
+# /ranking の集計結果を少しの間使い回す（同じ部活・期間の連続した問い合わせで RPC を繰り返さない）
+# key: (club_id, period) -> (期限 (time.monotonic), 集計開始日, [(user_id, count), ...])
+# 新しいスタンプが入ったら record_stamps でその部活の分を捨てる
+RANKING_PERIODS = ("week", "month", "year")
+RANKING_CACHE_TTL = 60
+ranking_cache: Dict[Tuple[str, str], Tuple[float, date, List[Tuple[int, int]]]] = {}
+
+
 async def get_ranking(club: ClubConfig, period: str) -> List[Tuple[int, int]]:
     """
     period: 'week', 'month', 'year'
     戻り値: [(user_id, count), ...] のリスト
     """
-    now = datetime.now(timezone(timedelta(hours=9)))
+    now = datetime.now(JST)
     today = now.date()
 
     if period == 'week':
@@ -711,24 +905,27 @@ async def get_ranking(club: ClubConfig, period: str) -> List[Tuple[int, int]]:
     else:
         return []
 
-    res = (
-        supabase.table("stamps")
-        .select("user_id")
-        .eq("guild_id", club.guild_id)
-        .eq("club_id", club.club_id)
-        .gte("date", start_date.isoformat())
-        .execute()
+    key = (club.club_id, period)
+    cached = ranking_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic() and cached[1] == start_date:
+        return cached[2]
+
+    # 集計は Postgres 側 (supabase/migrations の get_club_ranking) で行い、上位10件だけ受け取る
+    res = await asyncio.to_thread(
+        lambda: supabase.rpc(
+            "get_club_ranking",
+            {
+                "p_guild_id": club.guild_id,
+                "p_club_id": club.club_id,
+                "p_start": start_date.isoformat(),
+                "p_limit": 10,
+            },
+        ).execute()
     )
 
-    # ユーザーごとにカウント
-    counts = {}
-    for r in res.data:
-        uid = r["user_id"]
-        counts[uid] = counts.get(uid, 0) + 1
-
-    # カウント順にソートして上位10名を取得
-    sorted_ranking = sorted(counts.items(), key=lambda x: x[1], reverse=True)
-    return sorted_ranking[:10]
+    result = [(r["user_id"], r["cnt"]) for r in res.data]
+    ranking_cache[key] = (time.monotonic() + RANKING_CACHE_TTL, start_date, result)
+    return result
 
 
 # ====== ランキングコマンド ======
@@ -761,12 +958,17 @@ async def ranking(interaction: discord.Interaction, club_name: str, period: str)
     if not ranking_data:
         embed.description = "まだこの期間のスタンプ記録がありません。🌱"
     else:
+        # 表示名は先にまとめて解決する（メンバーキャッシュにいない人はID表示）
+        name_map: Dict[int, str] = {}
+        for user_id, _ in ranking_data:
+            member = interaction.guild.get_member(user_id)
+            if member:
+                name_map[user_id] = member.display_name
+
         ranking_list = []
         for i, (user_id, count) in enumerate(ranking_data, 1):
-            # メンバー名を取得（キャッシュになければID表示）
-            member = interaction.guild.get_member(user_id)
-            name = member.display_name if member else f"User({user_id})"
-            
+            name = name_map.get(user_id, f"User({user_id})")
+
             # メダル絵文字の装飾
             medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(i, f"**{i}位**")
             ranking_list.append(f"{medal} {name} ― `{count}個`")
@@ -779,6 +981,29 @@ async def ranking(interaction: discord.Interaction, club_name: str, period: str)
 
 
 # ====== ★追加機能　/callm 機能のUIコンポーネント ======
+# ロールのメンバー一覧のキャッシュ。role.members は呼ぶたびにサーバーの全メンバーを走査するので、
+# 同じロールを続けて開いたときやページ送りのたびに作り直さない（多少古くても困らないので TTL のみ）
+# key: (guild_id, role_id) -> (期限 (time.monotonic), [Member])
+ROLE_MEMBERS_CACHE_TTL = 30
+role_members_cache: Dict[Tuple[int, int], Tuple[float, List[discord.Member]]] = {}
+
+
+def get_role_members(role: discord.Role) -> List[discord.Member]:
+    key = (role.guild.id, role.id)
+    cached = role_members_cache.get(key)
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    # 期限切れのものはここでついでに捨てる
+    for k in [k for k, (expires, _) in role_members_cache.items() if expires <= now]:
+        del role_members_cache[k]
+
+    members = role.members
+    role_members_cache[key] = (now + ROLE_MEMBERS_CACHE_TTL, members)
+    return members
+
+
 class PageButton(discord.ui.Button):
     def __init__(self, label: str, direction: int):
         super().__init__(label=label)
@@ -787,32 +1012,47 @@ class PageButton(discord.ui.Button):
     async def callback(self, interaction: discord.Interaction):
         # ★ defer()を使わずにedit_messageで応答する
         view: MemberSelectView = self.view
-        new_page = view.page + self.direction
-        
-        # 新しいページでViewを再生成してメッセージを更新
-        await interaction.response.edit_message(
-            view=MemberSelectView(view.members, new_page)
-        )
+
+        role = interaction.guild.get_role(view.role_id)
+        if role is None:
+            return await interaction.response.send_message("ロールが見つかりません。", ephemeral=True)
+
+        # View は作り直さず、ページだけ進めて中身を差し替える
+        view.page += self.direction
+        view.update_items(role)
+        await interaction.response.edit_message(view=view)
 
 class MemberSelectView(discord.ui.View):
-    def __init__(self, members: List[discord.Member], page=0):
+    # メンバー一覧そのものは持たず (role_id, page, total) だけ持つ。
+    # ページを作るときに get_role_members のキャッシュから今のページの分だけ切り出す
+    def __init__(self, role: discord.Role, page=0):
         super().__init__(timeout=180)
-        self.members = members
+        self.role_id = role.id
         self.page = page
         self.per_page = 25
+        self.total = 0
+        self.select: Optional[discord.ui.Select] = None
+        self.update_items(role)
+
+    def update_items(self, role: discord.Role):
+        """今の self.page に合わせてセレクトメニューとボタンを並べ直す"""
+        self.clear_items()
 
-        start = page * self.per_page
+        members = get_role_members(role)
+        self.total = len(members)
+
+        start = self.page * self.per_page
         end = start + self.per_page
         current_members = members[start:end]
 
         options = [
-            discord.SelectOption(label=m.display_name, value=str(m.id))
+            discord.SelectOption(label=m.display_name[:100], value=str(m.id))
             for m in current_members
         ]
 
         if options:
             self.select = discord.ui.Select(
-                placeholder=f"メンションする人を選択 (Page {page + 1})",
+                placeholder=f"メンションする人を選択 (Page {self.page + 1})",
                 min_values=1,
                 max_values=len(options),
                 options=options
@@ -821,11 +1061,12 @@ class MemberSelectView(discord.ui.View):
             self.select.callback = self.select_callback 
             self.add_item(self.select)
         else:
+            self.select = None
             self.add_item(discord.ui.Button(label="このページにメンバーはいません", disabled=True))
 
-        if page > 0:
+        if self.page > 0:
             self.add_item(PageButton("◀ 前", -1))
-        if len(members) > end:
+        if self.total > end:
             self.add_item(PageButton("次 ▶", 1))
 
         send_btn = discord.ui.Button(
@@ -841,7 +1082,7 @@ class MemberSelectView(discord.ui.View):
 
     async def open_modal(self, interaction: discord.Interaction):
         # 選択チェック
-        if not hasattr(self, 'select') or not self.select.values:
+        if self.select is None or not self.select.values:
             return await interaction.response.send_message("メンバーが一人も選択されていません。", ephemeral=True)
         
         mentions = " ".join([f"<@{m_id}>" for m_id in self.select.values])
@@ -878,11 +1119,25 @@ class CallmMessageModal(discord.ui.Modal, title='送信メッセージ入力'):
 
 # ====== /callm コマンド本体 ======
 
+# /callm の選択肢になるロールIDのキャッシュ。callm_add / callm_del で書き換えたら捨てる
+callm_role_cache: Dict[int, List[int]] = {}  # guild_id -> [role_id]
+
+
+async def get_callm_role_ids(guild_id: int) -> List[int]:
+    role_ids = callm_role_cache.get(guild_id)
+    if role_ids is None:
+        res = await asyncio.to_thread(
+            lambda: supabase.table("callm_roles").select("role_id").eq("guild_id", guild_id).execute()
+        )
+        role_ids = [row['role_id'] for row in res.data]
+        callm_role_cache[guild_id] = role_ids
+    return role_ids
+
+
 @bot.tree.command(name="callm", description="登録済みロールからメンバーを選んで一括メンションします")
 async def callm(interaction: discord.Interaction):
-    # Supabaseから登録済みロールを取得
-    res = supabase.table("callm_roles").select("role_id").eq("guild_id", interaction.guild_id).execute()
-    role_ids = [row['role_id'] for row in res.data]
+    # 登録済みロールを取得（キャッシュになければ Supabase から）
+    role_ids = await get_callm_role_ids(interaction.guild_id)
 
     if not role_ids:
         return await interaction.response.send_message("登録されているロールがありません。`/callm_add` で追加してください。", ephemeral=True)
@@ -907,7 +1162,7 @@ async def callm(interaction: discord.Interaction):
 
         await inter.followup.send(
             f"**{selected_role.name}** のメンバーを選択してください:",
-            view=MemberSelectView(selected_role.members),
+            view=MemberSelectView(selected_role),
             ephemeral=True
         )
 
@@ -924,10 +1179,13 @@ async def callm(interaction: discord.Interaction):
 async def callm_add(interaction: discord.Interaction, role: discord.Role):
     try:
         # Upsertで登録
-        supabase.table("callm_roles").upsert({
-            "guild_id": interaction.guild_id,
-            "role_id": role.id
-        }).execute()
+        await asyncio.to_thread(
+            lambda: supabase.table("callm_roles").upsert({
+                "guild_id": interaction.guild_id,
+                "role_id": role.id
+            }).execute()
+        )
+        callm_role_cache.pop(interaction.guild_id, None)
         await interaction.response.send_message(f"ロール `{role.name}` を /callm のリストに追加しました。")
     except Exception as e:
         await interaction.response.send_message(f"エラーが発生しました: {e}", ephemeral=True)
@@ -936,7 +1194,10 @@ async def callm_add(interaction: discord.Interaction, role: discord.Role):
 @app_commands.default_permissions(administrator=True)
 async def callm_del(interaction: discord.Interaction, role: discord.Role):
     try:
-        supabase.table("callm_roles").delete().eq("guild_id", interaction.guild_id).eq("role_id", role.id).execute()
+        await asyncio.to_thread(
+            lambda: supabase.table("callm_roles").delete().eq("guild_id", interaction.guild_id).eq("role_id", role.id).execute()
+        )
+        callm_role_cache.pop(interaction.guild_id, None)
         await interaction.response.send_message(f"ロール `{role.name}` を /callm のリストから削除しました。")
     except Exception as e:
         await interaction.response.send_message(f"エラーが発生しました: {e}", ephemeral=True)
@@ -946,8 +1207,9 @@ async def callm_del(interaction: discord.Interaction, role: discord.Role):
 
 async def main():
     async with bot:
-        # スラッシュコマンドの同期
-        await bot.start(DISCORD_TOKEN)
+        # Bot とヘルスチェック用のAPIサーバーを同じイベントループで一緒に動かす
+        # （スラッシュコマンドの同期は setup_hook で行う）
+        await asyncio.gather(serve_api(), bot.start(DISCORD_TOKEN))
 
 
 if __name__ == "__main__":
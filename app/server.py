@@ -7,9 +7,9 @@ app = FastAPI()
 def health():
     return {"status": "ok"}
 
-def run():
+async def serve():
+    # Discordボットと同じイベントループ上でタスクとして動かす（別スレッドは使わない）
     import uvicorn
     port = int(os.getenv("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
-
-
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, loop="asyncio")
+    await uvicorn.Server(config).serve()
@@ -0,0 +1,130 @@
+"""
+/card のスタンプカード画像生成。
+
+main.py の card_executor（スレッドプール）から呼ばれる。Bot や Supabase には触らず、
+引数は str / int / bool / tuple、戻り値は PNG の bytes だけにしておく。
+"""
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Tuple
+
+from app.date.calendar_utils import get_month_positions
+
+# PIL は /card を呼ぶまで使わないので、起動時には読み込まない（各関数の中で import する）
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+IMAGES_DIR = os.path.join(os.path.dirname(__file__), "images")
+
+# マスの左上 (get_month_positions の座標) からスタンプを置く位置までのずらし量
+# 中央寄せにしたい場合はここを調整する（例: (15, 10) など）
+STAMP_OFFSET = (15, 5)
+
+
+@lru_cache(maxsize=1)
+def load_stamp_image() -> "Image.Image":
+    """
+    images/stamp.png を読み込み、カレンダーのマスに収まる幅にリサイズして返す。
+    スタンプ画像は変わらないので、最初の /card で1回だけデコード・リサイズしてキャッシュする。
+    """
+    from PIL import Image
+
+    stamp_path = os.path.join(IMAGES_DIR, "stamp.png")
+    if not os.path.exists(stamp_path):
+        raise FileNotFoundError(f"スタンプ画像が見つかりません: {stamp_path}")
+
+    stamp_img = Image.open(stamp_path).convert("RGBA")
+
+    # マス目のサイズ (330, 270) より少し小さくすると綺麗に収まります
+    # 幅 250px にリサイズ（アスペクト比を維持）
+    target_width = 250
+    ratio = target_width / stamp_img.width
+    target_height = int(stamp_img.height * ratio)
+    return stamp_img.resize((target_width, target_height), Image.LANCZOS)
+
+
+@lru_cache(maxsize=64)
+def resolve_calendar_base_path(prefix: str, year: int, month: int, is_night: bool) -> str:
+    """
+    ベース画像のパスを決める。
+    ファイル名: images/{prefix}_yyyy_mm(.png or _n.png)、なければ calendar_base_yyyy_mm に fallback。
+    画像はデプロイ時にしか変わらないので、存在確認の結果ごとキャッシュする
+    （見つからない場合は例外なのでキャッシュされない）。
+    """
+    suffix = "_n" if is_night else ""
+
+    # ベース名（例）: calendar_base_2025_01.png / calendar_base_2025_01_n.png
+    path = os.path.join(IMAGES_DIR, f"{prefix}_{year}_{month:02d}{suffix}.png")
+
+    if not os.path.exists(path):
+        # デフォルト名 fallback
+        path = os.path.join(IMAGES_DIR, f"calendar_base_{year}_{month:02d}{suffix}.png")
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"カレンダーベース画像が見つかりません: {path}")
+
+    return path
+
+
+@lru_cache(maxsize=4)
+def _open_base_image(path: str) -> "Image.Image":
+    # デコード済みのベース画像をキャッシュする（呼び出し側で copy() して使うこと）
+    from PIL import Image
+
+    return Image.open(path).convert("RGBA")
+
+
+def load_calendar_base_image(prefix: str, year: int, month: int, is_night: bool) -> "Image.Image":
+    """
+    指定月のカレンダー画像ベースを読み込む。
+    prefix で切り替え可能とする。
+    戻り値はキャッシュのコピーなので、そのまま書き込んでよい。
+    """
+    path = resolve_calendar_base_path(prefix, year, month, is_night)
+    return _open_base_image(path).copy()
+
+
+@lru_cache(maxsize=4)
+def get_stamp_positions(year: int, month: int) -> Dict[int, Tuple[int, int]]:
+    """
+    その月の各日 (day -> (x, y)) に、スタンプを貼る左上座標を返す。
+    マスの座標にずらし量を足すのも (year, month) ごとに1回だけ。
+    """
+    dx, dy = STAMP_OFFSET
+    return {
+        day: (int(x + dx), int(y + dy))
+        for day, (x, y) in get_month_positions(year, month).items()
+    }
+
+
+def render_stamp_card(
+    prefix: str,
+    is_night: bool,
+    year: int,
+    month: int,
+    stamp_days: Tuple[int, ...],
+) -> bytes:
+    """
+    year/month のカレンダーに stamp_days（その月の日付の「日」）のスタンプを押した PNG を返す。
+    """
+    from io import BytesIO
+
+    # ベース画像を読み込み
+    img = load_calendar_base_image(prefix, year, month, is_night)
+
+    # スタンプを合成（今月まだ1つもなければスタンプ画像の用意ごと省く）
+    stamp_img = load_stamp_image() if stamp_days else None
+    positions = get_stamp_positions(year, month)
+    for day in stamp_days:
+        dest = positions[day]
+        try:
+            img.alpha_composite(stamp_img, dest=dest)
+        except Exception as e:
+            print(f"Stamp position error for {year}-{month:02d}-{day:02d}: {e}")
+            continue
+
+    buf = BytesIO()
+    # Discord に一度送るだけの画像なので、圧縮率よりエンコード速度を優先する (デフォルトは 6)
+    img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
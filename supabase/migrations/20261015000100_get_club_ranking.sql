@@ -0,0 +1,20 @@
+-- /ranking 用: 期間内のスタンプ数をユーザーごとに集計して上位だけ返す
+create or replace function public.get_club_ranking(
+    p_guild_id bigint,
+    p_club_id uuid,
+    p_start date,
+    p_limit integer default 10
+)
+returns table (user_id bigint, cnt bigint)
+language sql
+stable
+as $$
+    select s.user_id, count(*) as cnt
+    from public.stamps s
+    where s.guild_id = p_guild_id
+      and s.club_id = p_club_id
+      and s.date >= p_start
+    group by s.user_id
+    order by cnt desc
+    limit p_limit;
+$$;
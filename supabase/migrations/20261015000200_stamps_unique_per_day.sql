@@ -0,0 +1,15 @@
+-- 1ユーザー・1部活・1日につきスタンプは1つ。
+-- presence_checker の upsert(on_conflict=..., ignore_duplicates) はこの制約を前提にしている
+
+-- 既存の重複行を1件だけ残して削除
+delete from public.stamps a
+using public.stamps b
+where a.ctid > b.ctid
+  and a.user_id = b.user_id
+  and a.guild_id = b.guild_id
+  and a.club_id = b.club_id
+  and a.date = b.date;
+
+alter table public.stamps
+    add constraint stamps_user_guild_club_date_key
+    unique (user_id, guild_id, club_id, date);
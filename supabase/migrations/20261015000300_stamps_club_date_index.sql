@@ -0,0 +1,4 @@
+-- ユーザー単位の検索 (/card) は stamps_user_guild_club_date_key のユニーク索引で足りる。
+-- 部活単位で日付範囲を見る検索 (get_club_ranking など) 用の索引を追加する
+create index if not exists stamps_guild_club_date_idx
+    on public.stamps (guild_id, club_id, date);
@@ -0,0 +1,34 @@
+-- /card 用: ユーザーのスタンプ統計 (累計, 現在の連続日数, 最大連続日数) を1行で返す
+-- 連続区間は「日付 - 行番号」が同じ値になることを使ってまとめる (gaps and islands)
+-- 現在の連続は、今日か昨日で終わっている区間の長さ (どちらもなければ 0)
+create or replace function public.user_streak_stats(
+    p_user_id bigint,
+    p_guild_id bigint,
+    p_club_id uuid,
+    p_today date
+)
+returns table (total integer, current_streak integer, max_streak integer)
+language sql
+stable
+as $$
+    with d as (
+        select distinct s.date
+        from public.stamps s
+        where s.user_id = p_user_id
+          and s.guild_id = p_guild_id
+          and s.club_id = p_club_id
+    ),
+    g as (
+        select d.date, d.date - (row_number() over (order by d.date))::integer as grp
+        from d
+    ),
+    islands as (
+        select count(*)::integer as len, max(g.date) as last_day
+        from g
+        group by g.grp
+    )
+    select
+        (select count(*)::integer from d) as total,
+        coalesce((select i.len from islands i where i.last_day between p_today - 1 and p_today), 0) as current_streak,
+        coalesce((select max(i.len) from islands i), 0) as max_streak;
+$$;
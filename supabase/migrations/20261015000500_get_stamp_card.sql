@@ -0,0 +1,44 @@
+-- /card 用: スタンプ統計と今月のスタンプ日付を1回の RPC でまとめて返す
+-- (user_streak_stats の置き換え。統計の求め方は同じ)
+create or replace function public.get_stamp_card(
+    p_user_id bigint,
+    p_guild_id bigint,
+    p_club_id uuid,
+    p_today date
+)
+returns table (total integer, current_streak integer, max_streak integer, month_dates date[])
+language sql
+stable
+as $$
+    with d as (
+        select distinct s.date
+        from public.stamps s
+        where s.user_id = p_user_id
+          and s.guild_id = p_guild_id
+          and s.club_id = p_club_id
+    ),
+    g as (
+        select d.date, d.date - (row_number() over (order by d.date))::integer as grp
+        from d
+    ),
+    islands as (
+        select count(*)::integer as len, max(g.date) as last_day
+        from g
+        group by g.grp
+    )
+    select
+        (select count(*)::integer from d) as total,
+        coalesce((select i.len from islands i where i.last_day between p_today - 1 and p_today), 0) as current_streak,
+        coalesce((select max(i.len) from islands i), 0) as max_streak,
+        coalesce(
+            (
+                select array_agg(d.date order by d.date)
+                from d
+                where d.date >= date_trunc('month', p_today)::date
+                  and d.date < (date_trunc('month', p_today) + interval '1 month')::date
+            ),
+            '{}'::date[]
+        ) as month_dates;
+$$;
+
+drop function if exists public.user_streak_stats(bigint, bigint, uuid, date);
@@ -0,0 +1,7 @@
+-- 1ギルドにつき同じ名前の部活は1つ。
+-- add_club_to_db は事前の存在確認をせず、この制約違反 (23505) を「登録済み」として扱う
+-- （既存データに重複があるとこの migration は失敗するので、先にどちらを残すか決めて整理すること）
+
+alter table public.clubs
+    add constraint clubs_guild_id_name_key
+    unique (guild_id, name);
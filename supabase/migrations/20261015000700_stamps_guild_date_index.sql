@@ -0,0 +1,4 @@
+-- preload_today_stamps はギルドの全部活分をまとめて取るので、条件は guild_id と date だけ。
+-- stamps_guild_club_date_idx では club_id を飛ばせず date で絞れないため、専用の索引を追加する
+create index if not exists stamps_guild_date_idx
+    on public.stamps (guild_id, date);